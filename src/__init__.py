@@ -1,3 +1,3 @@
-from ._psnawp import get_psn_user, PSNUserProfile
+from ._psnawp import get_psn_user, PSNUserProfile, PSNClient
 
-__all__ = ["get_psn_user", "PSNUserProfile"]
\ No newline at end of file
+__all__ = ["get_psn_user", "PSNUserProfile", "PSNClient"]
\ No newline at end of file
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+import httpx
+if __package__:
+    from ._ratelimit import TokenBucket, MAX_ATTEMPTS, RateLimited, rate_settings, sync_bucket, retry_delay, should_retry
+else:
+    # Run from inside src/ (e.g. uvicorn app:app), with no parent package
+    from _ratelimit import TokenBucket, MAX_ATTEMPTS, RateLimited, rate_settings, sync_bucket, retry_delay, should_retry
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://m.np.playstation.com/api"
+LEGACY_PROFILE_URL = "https://us-prof.np.community.playstation.net/userProfile/v1/users"
+
+# Connection limits for the shared HTTP/2 client
+MAX_CONNECTIONS = 128
+MAX_KEEPALIVE_CONNECTIONS = 64
+# Access tokens last an hour; refresh well before that
+TOKEN_TTL = 30 * 60
+# Page sizes for the paginated title endpoints
+TROPHY_TITLES_PAGE_SIZE = 800
+TITLE_STATS_PAGE_SIZE = 200
+# Most online IDs the legacy batch profile endpoint accepts per call
+LEGACY_PROFILES_CHUNK_SIZE = 50
+
+# What a PSN call can fail with, short of RateLimited: an HTTP error once
+# retries are used up, or a response without the fields we read
+PSN_ERRORS = (httpx.HTTPError, KeyError, ValueError)
+
+class AsyncPSNClient:
+    """Async transport for the handful of PSN endpoints this API uses
+
+    Authentication stays with PSNAWP: token_provider is called (in a worker
+    thread) to get a fresh access token whenever the cached one is stale.
+    """
+
+    def __init__(self, token_provider: Callable[[], str]):
+        self._token_provider = token_provider
+        self._access_token: Optional[str] = None
+        self._token_expires = 0.0
+        self._token_lock = asyncio.Lock()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._rate, self._burst, self._max_wait = rate_settings()
+        self._http = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS
+            ),
+            timeout=httpx.Timeout(10.0),
+            headers={"Accept-Language": "en-US", "Country": "US"}
+        )
+
+    async def aclose(self) -> None:
+        """Close the underlying HTTP connections"""
+        await self._http.aclose()
+
+    async def _token(self, refresh: bool = False) -> str:
+        """Get a valid access token, asking PSNAWP for a new one when stale"""
+        async with self._token_lock:
+            if refresh or self._access_token is None or time.monotonic() >= self._token_expires:
+                self._access_token = await asyncio.to_thread(self._token_provider)
+                self._token_expires = time.monotonic() + TOKEN_TTL
+            return self._access_token
+
+    def _bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self._rate, self._burst)
+        return self._buckets[host]
+
+    async def _get(self, url: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        """GET a PSN endpoint and return its JSON body
+
+        Calls are paced per host and retried with backoff on 429/5xx, the
+        same way RateLimitedAdapter handles PSNAWP's own requests. An
+        expired token is refreshed once on 401. Raises RateLimited rather
+        than waiting more than PSN_MAX_WAIT seconds in total on the rate limit.
+        """
+        bucket = self._bucket(url)
+        deadline = time.monotonic() + self._max_wait
+        refreshed = False
+        attempt = 0
+        while True:
+            wait = bucket.reserve(max(0.0, deadline - time.monotonic()))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            token = await self._token()
+            response = await self._http.get(
+                url, params=params, headers={"Authorization": f"Bearer {token}"}
+            )
+            sync_bucket(bucket, response.headers)
+            if response.status_code == 401 and not refreshed:
+                refreshed = True
+                await self._token(refresh=True)
+                continue
+            if should_retry(response.status_code) and attempt < MAX_ATTEMPTS - 1:
+                delay = retry_delay(attempt, response.headers)
+                if delay > deadline - time.monotonic():
+                    if response.status_code == 429:
+                        raise RateLimited(delay)
+                    response.raise_for_status()
+                logger.warning(
+                    "PSN returned %s for %s, retrying in %.1fs",
+                    response.status_code, url, delay
+                )
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    async def account_id(self, online_id: str) -> str:
+        """Resolve an online ID to its account ID"""
+        data = await self._get(
+            f"{LEGACY_PROFILE_URL}/{online_id}/profile2",
+            params={"fields": "accountId,onlineId,currentOnlineId"}
+        )
+        return data["profile"]["accountId"]
+
+    async def legacy_profiles(self, online_ids: List[str], fields: List[str]) -> List[Dict[str, Any]]:
+        """Fetch legacy profiles for many online IDs, chunked per call"""
+        chunks = [
+            online_ids[start:start + LEGACY_PROFILES_CHUNK_SIZE]
+            for start in range(0, len(online_ids), LEGACY_PROFILES_CHUNK_SIZE)
+        ]
+        responses = await asyncio.gather(*[
+            self._get(
+                f"{LEGACY_PROFILE_URL}/profiles2",
+                params={"onlineIds": ",".join(chunk), "fields": ",".join(fields)}
+            )
+            for chunk in chunks
+        ])
+        return [profile for data in responses for profile in data.get("profiles", [])]
+
+    async def profile(self, account_id: str) -> Dict[str, Any]:
+        """Get a user's profile"""
+        return await self._get(f"{API_URL}/userProfile/v1/internal/users/{account_id}/profiles")
+
+    async def presence(self, account_id: str) -> Dict[str, Any]:
+        """Get a user's basic presence"""
+        data = await self._get(
+            f"{API_URL}/userProfile/v1/internal/users/{account_id}/basicPresences",
+            params={"type": "primary"}
+        )
+        return data.get("basicPresence", data)
+
+    async def friendship(self, account_id: str) -> Dict[str, Any]:
+        """Get the friendship summary between you and a user"""
+        return await self._get(f"{API_URL}/userProfile/v1/internal/users/me/friends/{account_id}/summary")
+
+    async def is_blocked(self, account_id: str) -> bool:
+        """Check whether you are blocking a user"""
+        data = await self._get(f"{API_URL}/userProfile/v1/internal/users/me/blocks")
+        return account_id in data.get("blockList", [])
+
+    async def trophy_summary(self, account_id: str) -> Dict[str, Any]:
+        """Get a user's trophy level and earned trophy counts"""
+        return await self._get(f"{API_URL}/trophy/v1/users/{account_id}/trophySummary")
+
+    async def _paginate(
+        self, url: str, key: str, page_size: int, limit: Optional[int], params: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Yield items from a paginated endpoint, one page at a time"""
+        offset = 0
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            data = await self._get(url, params={**(params or {}), "limit": size, "offset": offset})
+            items = data.get(key, [])
+            for item in items:
+                yield item
+            if remaining is not None:
+                remaining -= len(items)
+            next_offset = data.get("nextOffset")
+            if not items or next_offset is None:
+                return
+            offset = next_offset
+
+    def trophy_titles(self, account_id: str, limit: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over the games a user has trophies for"""
+        return self._paginate(
+            f"{API_URL}/trophy/v1/users/{account_id}/trophyTitles",
+            "trophyTitles", TROPHY_TITLES_PAGE_SIZE, limit
+        )
+
+    def title_stats(self, account_id: str, limit: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over play statistics for the games a user has played"""
+        return self._paginate(
+            f"{API_URL}/gamelist/v2/users/{account_id}/titles",
+            "titles", TITLE_STATS_PAGE_SIZE, limit,
+            params={"categories": "ps4_game,ps5_native_game"}
+        )
@@ -1,112 +1,412 @@
+import asyncio
+import logging
 import os
-from typing import Dict, Any, List, Optional, ClassVar, Union, Generator
-from pydantic import BaseModel, Field
+import threading
+from typing import Dict, Any, List, Optional, Union, Generator, Callable, Awaitable, AsyncIterator, Hashable
 from psnawp_api import PSNAWP
 from psnawp_api.models import User as PSNUser
-from functools import lru_cache
+import requests
+if __package__:
+    from ._ratelimit import RateLimitedAdapter
+    from ._async_client import AsyncPSNClient, PSN_ERRORS
+else:
+    # Run from inside src/ (e.g. uvicorn app:app), with no parent package
+    from _ratelimit import RateLimitedAdapter
+    from _async_client import AsyncPSNClient, PSN_ERRORS
+from psnawp_api.core.psnawp_exceptions import PSNAWPError
+from dataclasses import dataclass, field
+from cachetools import TTLCache
 try:
     # For region information
     import pycountry
     HAS_PYCOUNTRY = True
 except ImportError:
     HAS_PYCOUNTRY = False
+try:
+    # For persisting rarely-changing profile data across restarts
+    import diskcache
+    HAS_DISKCACHE = True
+except ImportError:
+    HAS_DISKCACHE = False
+
+logger = logging.getLogger(__name__)
+
+# What the blocking PSNAWP pass-throughs can fail with, short of RateLimited
+PSNAWP_ERRORS = (PSNAWPError, requests.RequestException)
+
+# Connections kept open per host, matching the batch fan-out in routes.py
+POOL_SIZE = 64
+
+# Profile fields the batch endpoint can serve, mapped to its own field names
+BATCH_PROFILE_FIELDS = {
+    "online_id": "onlineId",
+    "account_id": "accountId",
+    "about_me": "aboutMe",
+    "avatars": "avatarUrls",
+    "languages": "languagesUsed",
+    "is_plus": "plus",
+    "is_officially_verified": "isOfficiallyVerified",
+}
+
+def _requester(client: PSNAWP) -> Any:
+    """Find the object PSNAWP uses to send authorized requests"""
+    # psnawp 3.x hangs the request builder off the authenticator,
+    # older releases keep a private one on the client itself
+    return getattr(client, "authenticator", None) or getattr(client, "_request_builder", None)
+
+def _http_session(client: PSNAWP) -> Optional[requests.Session]:
+    """Find the requests.Session that PSNAWP sends its calls through"""
+    requester = _requester(client)
+    builder = getattr(requester, "request_builder", requester)
+    session = getattr(builder, "session", None)
+    return session if isinstance(session, requests.Session) else None
+
+def _fresh_access_token(client: PSNAWP) -> str:
+    """Get a valid access token from PSNAWP, logging in or refreshing as needed"""
+    requester = _requester(client)
+    if hasattr(requester, "token_response"):
+        # psnawp 3.x logs in on the first request and keeps the tokens in
+        # token_response; refreshing is a no-op while the token is valid
+        if requester.token_response is None:
+            requester.fetch_access_token_from_authorization(requester.get_authorization_code())
+        else:
+            requester.fetch_access_token_from_refresh()
+        return requester.token_response["access_token"]
+    # Older request builders keep the authenticator one level down
+    authenticator = getattr(requester, "authenticator", requester)
+    obtain = getattr(authenticator, "obtain_fresh_access_token", None)
+    return obtain() if obtain is not None else authenticator.access_token
+
+# Per-user cache lifetimes in seconds, one cache per data source so each
+# expires on its own schedule: profiles rarely change, presence constantly
+CACHE_TTLS = {
+    "account_id": 24 * 60 * 60,
+    "profile": 3600,
+    "presence": 30,
+    "friendship": 300,
+    "trophy_summary": 600,
+    "is_blocking": 300,
+}
+CACHE_SIZE = 1000
+
+# On-disk cache shared across restarts, stored as plain JSON for debugging.
+# Only these sources are persisted, and they expire on the same schedule
+# as in memory, so a restart never serves anything staler than CACHE_TTLS.
+DEFAULT_DISK_CACHE_DIR = "/var/cache/psn"
+DISK_CACHED = frozenset({"account_id", "profile", "presence"})
+
+def _open_disk_cache(directory: str) -> Optional["diskcache.Cache"]:
+    """Open the on-disk cache, or return None if it can't be opened"""
+    try:
+        return diskcache.Cache(directory, disk=diskcache.JSONDisk, disk_compress_level=0)
+    except Exception:
+        logger.exception("Error opening disk cache at %s", directory)
+        return None
 
 class PSNClient:
-    """Singleton client for PSNAWP API"""
-    _instance: ClassVar[Optional['PSNClient']] = None
-    _client: PSNAWP
-
-    def __new__(cls):
-        if cls._instance is None:
-            npsso = os.getenv("NPSSO")
-            if not npsso:
-                raise ValueError("NPSSO environment variable must be set")
-            cls._instance = super(PSNClient, cls).__new__(cls)
-            cls._instance._client = PSNAWP(npsso)
-        return cls._instance
+    """PSNAWP login plus the shared async transport and per-user caches
+
+    Create one per app (see the lifespan in app.py) and pass it around, so
+    every request shares the same requests.Session, HTTP/2 connections and
+    cached data. Cached data also persists in cache_dir, when one is given
+    and diskcache is installed.
+    """
+
+    def __init__(self, npsso: Optional[str] = None, cache_dir: Optional[str] = None):
+        npsso = npsso or os.getenv("NPSSO")
+        if not npsso:
+            raise ValueError("NPSSO environment variable must be set")
+        client = PSNAWP(npsso)
+        session = _http_session(client)
+        if session is not None:
+            # Pool connections and pace/retry calls against PSN's rate limits
+            adapter = RateLimitedAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+        self._client = client
+        self._async_client = AsyncPSNClient(lambda: _fresh_access_token(client))
+        self._caches: Dict[str, TTLCache] = {
+            kind: TTLCache(maxsize=CACHE_SIZE, ttl=ttl) for kind, ttl in CACHE_TTLS.items()
+        }
+        # PSNAWP users for the blocking pass-through methods, used from threads
+        self._users: TTLCache = TTLCache(maxsize=CACHE_SIZE, ttl=3600)
+        self._users_lock = threading.Lock()
+        # Upstream fetches in progress, so concurrent callers for the same key share one
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._disk = _open_disk_cache(cache_dir) if cache_dir and HAS_DISKCACHE else None
 
     @property
     def client(self) -> PSNAWP:
         return self._client
 
-class PSNUserProfile(BaseModel):
-    """Pydantic model for a PlayStation Network user profile"""
-    online_id: str
-    _user: Optional[PSNUser] = None
-    _profile_data: Optional[Dict[str, Any]] = None
-    _presence_data: Optional[Dict[str, Any]] = None
-    _friendship_data: Optional[Dict[str, Any]] = None
-    _trophy_summary_data: Optional[Any] = None
-    _account_id: Optional[str] = None
+    @property
+    def async_client(self) -> AsyncPSNClient:
+        return self._async_client
+
+    async def aclose(self) -> None:
+        """Close the shared async HTTP connections and the disk cache"""
+        await self._async_client.aclose()
+        if self._disk is not None:
+            self._disk.close()
+
+    def user(self, online_id: str) -> PSNUser:
+        """Get or fetch the PSNAWP User for an online ID (blocking)"""
+        with self._users_lock:
+            user = self._users.get(online_id)
+        if user is None:
+            user = self._client.user(online_id=online_id)
+            with self._users_lock:
+                self._users[online_id] = user
+        return user
+
+    async def _disk_get(self, key: str) -> Any:
+        """Read a value from the on-disk cache, treating any disk error as a miss
+
+        diskcache is SQLite underneath, so the read runs in a worker thread
+        rather than on the event loop.
+        """
+        if self._disk is None:
+            return None
+        try:
+            return await asyncio.to_thread(self._disk.get, key)
+        except Exception:
+            logger.exception("Error reading %s from disk cache", key)
+            return None
+
+    async def _disk_set(self, key: str, value: Any, expire: float) -> None:
+        """Write a value to the on-disk cache in a worker thread, ignoring disk errors"""
+        if self._disk is None:
+            return
+        try:
+            await asyncio.to_thread(self._disk.set, key, value, expire=expire)
+        except Exception:
+            logger.exception("Error writing %s to disk cache", key)
+
+    def _forget_inflight(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark any exception retrieved in case every caller was cancelled
+            task.exception()
+
+    async def _single_flight(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Run fetch once for all concurrent callers with the same key
+
+        The fetch runs in its own task and each caller awaits it through a
+        shield, so cancelling one caller, including the one that started it,
+        leaves the fetch running for everyone else.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget_inflight(key, done))
+        return await asyncio.shield(task)
+
+    async def cached(self, kind: str, online_id: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value of one data source for a user
+
+        kind is a key of CACHE_TTLS. On a miss the value is looked up on
+        disk if the kind is in DISK_CACHED, then fetched and stored.
+        Concurrent misses for the same user and kind share a single fetch.
+        """
+        cache = self._caches[kind]
+        value = cache.get(online_id)
+        if value is not None:
+            return value
+
+        async def load() -> Any:
+            persist = kind in DISK_CACHED
+            disk_key = f"{kind}:{online_id}"
+            value = await self._disk_get(disk_key) if persist else None
+            if value is None:
+                value = await fetch()
+                if persist:
+                    await self._disk_set(disk_key, value, expire=CACHE_TTLS[kind])
+            cache[online_id] = value
+            return value
+
+        return await self._single_flight((kind, online_id), load)
+
+    async def _remember_account_id(self, online_id: str, account_id: str) -> None:
+        """Store a resolved account ID in memory and on disk"""
+        self._caches["account_id"][online_id] = account_id
+        await self._disk_set(f"account_id:{online_id}", account_id, expire=CACHE_TTLS["account_id"])
+
+    async def batch_profiles(self, online_ids: List[str], fields: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Fetch basic profile fields for many users with the batch endpoint
+
+        Only fields in BATCH_PROFILE_FIELDS are supported. Returns the
+        profiles keyed by lower-cased online ID; users PSN doesn't return
+        are left out.
+        """
+        # onlineId is always requested since results are keyed by it, and
+        # accountId so it can be remembered, sparing later per-user
+        # lookups the online ID resolution
+        psn_fields = {"onlineId", "accountId"} | {BATCH_PROFILE_FIELDS[f] for f in fields}
+        requested = {online_id.lower(): online_id for online_id in online_ids}
+        profiles = {}
+        account_ids = {}
+        for data in await self._async_client.legacy_profiles(online_ids, sorted(psn_fields)):
+            key = str(data.get("onlineId") or "").lower()
+            if not key:
+                # Can't tell which user this is; they fall back to a per-user fetch
+                continue
+            if key in requested and data.get("accountId"):
+                account_ids[requested[key]] = data["accountId"]
+            profiles[key] = _from_batch_profile(data, fields)
+        await asyncio.gather(*(
+            self._remember_account_id(online_id, account_id)
+            for online_id, account_id in account_ids.items()
+        ))
+        return profiles
+
+def _from_batch_profile(data: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    """Convert a batch endpoint profile into our field names"""
+    profile = {}
+    for name in fields:
+        value = data.get(BATCH_PROFILE_FIELDS[name])
+        if name == "avatars":
+            # The legacy endpoint names the URL key differently from profile()
+            value = [{"size": a.get("size"), "url": a.get("avatarUrl")} for a in value or []]
+        elif name in ("is_plus", "is_officially_verified"):
+            value = bool(value)
+        elif name == "languages":
+            value = value or []
+        elif value is None:
+            value = ""
+        profile[name] = value
+    return profile
 
-    class Config:
-        arbitrary_types_allowed = True
+@dataclass(slots=True)
+class PSNUserProfile:
+    """A PlayStation Network user profile, fetched lazily and cached per source"""
+    online_id: str
+    psn: PSNClient = field(repr=False)
+    _user: Optional[PSNUser] = field(default=None, init=False, repr=False)
+    _profile_data: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False)
+    _presence_data: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False)
+    _friendship_data: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False)
+    _trophy_summary_data: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False)
+    _is_blocking_data: Optional[bool] = field(default=None, init=False, repr=False)
+    _account_id: Optional[str] = field(default=None, init=False, repr=False)
 
     @property
     def user(self) -> PSNUser:
-        """Get or fetch the PSNUser object"""
+        """Get or fetch the PSNAWP User, for the pass-through methods below"""
         if self._user is None:
             try:
-                # Direct instance is more reliable than the singleton
-                psnawp_client = PSNAWP(os.getenv("NPSSO"))
-                self._user = psnawp_client.user(online_id=self.online_id)
-                self._account_id = self._user.account_id
-            except Exception as e:
-                print(f"Error fetching user {self.online_id}: {str(e)}")
+                self._user = self.psn.user(self.online_id)
+            except Exception:
+                logger.exception("Error fetching user %s", self.online_id)
                 raise
         return self._user
 
     @property
     def account_id(self) -> str:
-        """Get the user's account ID"""
-        if self._account_id is None:
-            self._account_id = self.user.account_id
-        return self._account_id
+        """The user's account ID, empty until resolve_account_id() has run"""
+        return self._account_id or ""
 
     @property
     def profile(self) -> Dict[str, Any]:
+        """The fetched user profile, empty until fetch_profile() has run"""
+        return self._profile_data or {}
+
+    @property
+    def presence(self) -> Dict[str, Any]:
+        """The fetched presence data, empty until fetch_presence() has run"""
+        return self._presence_data or {}
+
+    @property
+    def friendship(self) -> Dict[str, Any]:
+        """The fetched friendship data, empty until fetch_friendship() has run"""
+        return self._friendship_data or {}
+
+    @property
+    def trophy_summary(self) -> Dict[str, Any]:
+        """The fetched trophy summary, empty until fetch_trophy_summary() has run"""
+        return self._trophy_summary_data or {}
+
+    @property
+    def is_blocking(self) -> bool:
+        """Whether you are blocking this user, False until fetch_is_blocking() has run"""
+        return bool(self._is_blocking_data)
+
+    async def resolve_account_id(self) -> str:
+        """Get or resolve the user's account ID"""
+        if self._account_id is None:
+            try:
+                self._account_id = await self.psn.cached(
+                    "account_id", self.online_id,
+                    lambda: self.psn.async_client.account_id(self.online_id)
+                )
+            except Exception:
+                logger.exception("Error fetching user %s", self.online_id)
+                raise
+        return self._account_id
+
+    async def _fetch(self, kind: str, fetch: Callable[[str], Awaitable[Any]], default: Any) -> Any:
+        """Fetch one data source through the client's cache
+
+        PSN failures are logged and give the default instead, so one
+        missing source doesn't fail the whole profile. Anything else,
+        RateLimited included, propagates to the route.
+        """
+        try:
+            account_id = await self.resolve_account_id()
+            return await self.psn.cached(kind, self.online_id, lambda: fetch(account_id))
+        except PSN_ERRORS:
+            logger.exception("Error fetching %s for %s", kind, self.online_id)
+            return default
+
+    async def fetch_profile(self) -> Dict[str, Any]:
         """Get or fetch the user profile"""
         if self._profile_data is None:
-            try:
-                self._profile_data = self.user.profile()
-            except Exception as e:
-                print(f"Error fetching profile for {self.online_id}: {str(e)}")
-                self._profile_data = {}
+            self._profile_data = await self._fetch("profile", self.psn.async_client.profile, {})
         return self._profile_data
 
-    @property
-    def presence(self) -> Dict[str, Any]:
+    async def fetch_presence(self) -> Dict[str, Any]:
         """Get or fetch the user presence data"""
         if self._presence_data is None:
-            try:
-                self._presence_data = self.user.get_presence()
-            except Exception as e:
-                print(f"Error fetching presence for {self.online_id}: {str(e)}")
-                self._presence_data = {}
+            self._presence_data = await self._fetch("presence", self.psn.async_client.presence, {})
         return self._presence_data
-    
-    @property
-    def friendship(self) -> Dict[str, Any]:
+
+    async def fetch_friendship(self) -> Dict[str, Any]:
         """Get or fetch the friendship data"""
         if self._friendship_data is None:
-            try:
-                self._friendship_data = self.user.friendship()
-            except Exception as e:
-                print(f"Error fetching friendship for {self.online_id}: {str(e)}")
-                self._friendship_data = {}
+            self._friendship_data = await self._fetch("friendship", self.psn.async_client.friendship, {})
         return self._friendship_data
 
-    @property
-    def trophy_summary(self) -> Any:
-        """Get the user's trophy summary using the direct method"""
+    async def fetch_trophy_summary(self) -> Dict[str, Any]:
+        """Get or fetch the user's trophy summary"""
         if self._trophy_summary_data is None:
-            try:
-                self._trophy_summary_data = self.user.trophy_summary()
-            except Exception as e:
-                print(f"Error fetching trophy summary for {self.online_id}: {str(e)}")
-                self._trophy_summary_data = {}
+            self._trophy_summary_data = await self._fetch(
+                "trophy_summary", self.psn.async_client.trophy_summary, {}
+            )
         return self._trophy_summary_data
 
+    async def fetch_is_blocking(self) -> bool:
+        """Get or fetch whether you are blocking this user"""
+        if self._is_blocking_data is None:
+            self._is_blocking_data = await self._fetch("is_blocking", self.psn.async_client.is_blocked, False)
+        return self._is_blocking_data
+
+    async def prefetch(self, *sources: str) -> None:
+        """Fetch profile data sources concurrently
+
+        Sources are "profile", "presence", "friendship", "trophy_summary"
+        and "is_blocking"; all of them are fetched when none are named.
+        """
+        fetchers = {
+            "profile": self.fetch_profile,
+            "presence": self.fetch_presence,
+            "friendship": self.fetch_friendship,
+            "trophy_summary": self.fetch_trophy_summary,
+            "is_blocking": self.fetch_is_blocking,
+        }
+        # Resolve the account ID once up front so the fetches below share it
+        await self.resolve_account_id()
+        await asyncio.gather(*(fetchers[name]() for name in sources or fetchers))
+
     # Basic profile information
     def get_about_me(self) -> str:
         """Get the user's about me text"""
@@ -192,69 +492,54 @@ class PSNUserProfile(BaseModel):
     # Access methods to check blocking/following status
     def get_is_blocking(self) -> bool:
         """Check if you are blocking this user"""
-        try:
-            return self.user.is_blocked()
-        except Exception:
-            return False
+        return self.is_blocking
     
     def get_is_following(self) -> bool:
         """This info isn't directly available through PSNAWP API"""
         return False
     
-    # Trophy information - using direct methods
+    # Trophy information
     def get_trophy_level(self) -> int:
         """Get the user's trophy level"""
-        try:
-            trophy_data = self.trophy_summary
-            return trophy_data.trophy_level
-        except Exception:
-            return 0
+        return self.trophy_summary.get("trophyLevel", 0)
     
     def get_trophy_progress(self) -> int:
         """Get the user's trophy progress"""
-        try:
-            trophy_data = self.trophy_summary
-            return trophy_data.progress
-        except Exception:
-            return 0
+        return self.trophy_summary.get("progress", 0)
     
     def get_trophy_tier(self) -> int:
         """Get the user's trophy tier"""
-        try:
-            trophy_data = self.trophy_summary
-            return trophy_data.tier
-        except Exception:
-            return 0
+        return self.trophy_summary.get("tier", 0)
     
     def get_earned_trophies(self) -> Dict[str, int]:
         """Get the user's earned trophies"""
-        try:
-            trophy_data = self.trophy_summary
-            earned = trophy_data.earned_trophies
-            return {
-                "platinum": earned.platinum,
-                "gold": earned.gold,
-                "silver": earned.silver,
-                "bronze": earned.bronze
-            }
-        except Exception:
-            return {"platinum": 0, "gold": 0, "silver": 0, "bronze": 0}
+        earned = self.trophy_summary.get("earnedTrophies", {})
+        return {
+            "platinum": earned.get("platinum", 0),
+            "gold": earned.get("gold", 0),
+            "silver": earned.get("silver", 0),
+            "bronze": earned.get("bronze", 0)
+        }
+    
+    # Paginated trophy and game listings
+    async def get_trophy_titles(self, limit=None) -> AsyncIterator[Dict[str, Any]]:
+        """Get user's trophy titles
+
+        Errors propagate, so a failure part way through paging isn't
+        mistaken for the end of the list.
+        """
+        account_id = await self.resolve_account_id()
+        async for title in self.psn.async_client.trophy_titles(account_id, limit=limit):
+            yield title
     
     # Pass-through methods for more advanced trophy functions
-    def get_trophy_titles(self, limit=None):
-        """Get user's trophy titles"""
-        try:
-            return self.user.trophy_titles(limit=limit)
-        except Exception as e:
-            print(f"Error fetching trophy titles: {str(e)}")
-            return []
     
     def get_trophy_titles_for_title(self, title_ids):
         """Get user's trophy titles for specific titles"""
         try:
             return self.user.trophy_titles_for_title(title_ids=title_ids)
-        except Exception as e:
-            print(f"Error fetching trophy titles for title: {str(e)}")
+        except PSNAWP_ERRORS:
+            logger.exception("Error fetching trophy titles by title for %s", self.online_id)
             return []
     
     def get_trophies(self, np_communication_id, platform, include_progress=False):
@@ -265,26 +550,26 @@ class PSNUserProfile(BaseModel):
                 platform=platform,
                 include_progress=include_progress
             )
-        except Exception as e:
-            print(f"Error fetching trophies: {str(e)}")
+        except PSNAWP_ERRORS:
+            logger.exception("Error fetching trophies for %s", self.online_id)
             return []
     
-    def get_title_stats(self, limit=None):
+    async def get_title_stats(self, limit=None) -> AsyncIterator[Dict[str, Any]]:
         """Get detailed information about games the user has played
         
         Returns information about play time, play count, and other stats
-        for each game title the user has played.
+        for each game title the user has played. Like get_trophy_titles(),
+        errors propagate rather than ending the list early.
         """
-        try:
-            return self.user.title_stats(limit=limit)
-        except Exception as e:
-            print(f"Error fetching title stats: {str(e)}")
-            return []
+        account_id = await self.resolve_account_id()
+        async for title in self.psn.async_client.title_stats(account_id, limit=limit):
+            yield title
     
     # Construct full profile object
-    def get_full_profile(self) -> Dict[str, Any]:
+    async def get_full_profile(self) -> Dict[str, Any]:
         """Get a complete profile with all available information"""
-        profile = {
+        await self.prefetch()
+        return {
             # Basic info
             "online_id": self.online_id,
             "account_id": self.get_account_id(),
@@ -312,11 +597,13 @@ class PSNUserProfile(BaseModel):
             "trophy_tier": self.get_trophy_tier(),
             "earned_trophies": self.get_earned_trophies(),
         }
-        
-        # Clean up the profile by removing empty/zero values
-        return {k: v for k, v in profile.items() if v or v == 0 or v == False}
 
-@lru_cache(maxsize=100)
-def get_psn_user(online_id: str) -> PSNUserProfile:
-    """Get a PSN user profile (cached)"""
-    return PSNUserProfile(online_id=online_id)
\ No newline at end of file
+async def get_psn_user(psn: PSNClient, online_id: str) -> PSNUserProfile:
+    """Get a PSN user profile backed by the client's per-user caches
+
+    The account ID is resolved up front, so unknown users fail here.
+    Concurrent lookups of the same user share one upstream request.
+    """
+    user = PSNUserProfile(online_id=online_id, psn=psn)
+    await user.resolve_account_id()
+    return user
\ No newline at end of file
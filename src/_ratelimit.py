@@ -0,0 +1,157 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, Mapping, Optional, Tuple
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Default budget matches PSN's documented 300 requests per 15 minutes
+DEFAULT_RATE = 300 / 900
+DEFAULT_BURST = 300
+# Longest a single call may spend waiting on the rate limit, across the
+# bucket and any retries, before giving up rather than holding the caller
+DEFAULT_MAX_WAIT = 10.0
+# Retries for throttled (429) and server error (5xx) responses
+MAX_ATTEMPTS = 4
+BACKOFF_SECONDS = 0.5
+
+def rate_settings() -> Tuple[float, int, float]:
+    """Read the rate, burst and max wait, overridable from the environment
+
+    Read when a client is built rather than at import, so values set in
+    .env (loaded by app.py after its imports) still apply.
+    """
+    return (
+        float(os.getenv("PSN_RATE_LIMIT", DEFAULT_RATE)),
+        int(os.getenv("PSN_RATE_BURST", DEFAULT_BURST)),
+        float(os.getenv("PSN_MAX_WAIT", DEFAULT_MAX_WAIT)),
+    )
+
+class RateLimited(Exception):
+    """Raised instead of waiting longer than allowed for PSN's rate limit"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"PSN rate limit reached, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Thread-safe token bucket that can be resynced from rate-limit headers"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, max_wait: Optional[float] = None) -> float:
+        """Take a token, returning how many seconds to wait before using it
+
+        Raises RateLimited, without taking the token, when the wait would
+        be longer than max_wait.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                raise RateLimited(wait)
+            self._tokens -= 1
+            return wait
+
+    def acquire(self, max_wait: Optional[float] = None) -> None:
+        """Block until a token is available, for at most max_wait seconds"""
+        wait = self.reserve(max_wait)
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, remaining: int, reset_after: Optional[float]) -> None:
+        """Sync the bucket with the quota the server says is left"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, remaining)
+            if remaining <= 0 and reset_after:
+                # Out of quota: make the next caller wait for the window to reset
+                self._tokens = min(self._tokens, -reset_after * self.rate)
+
+def _parse_reset(value: str) -> Optional[float]:
+    """Seconds until a rate-limit window resets, from a reset header"""
+    try:
+        reset = float(value)
+    except ValueError:
+        return None
+    # Some APIs send an epoch timestamp rather than a delay
+    if reset > 1e9:
+        reset -= time.time()
+    return max(0.0, reset)
+
+def sync_bucket(bucket: TokenBucket, headers: Mapping[str, str]) -> None:
+    """Update a bucket from X-RateLimit-* response headers, if present"""
+    remaining = headers.get("X-RateLimit-Remaining")
+    if remaining is None:
+        return
+    try:
+        remaining_count = int(remaining)
+    except ValueError:
+        return
+    reset = headers.get("X-RateLimit-Reset")
+    bucket.update(remaining_count, _parse_reset(reset) if reset is not None else None)
+
+def retry_delay(attempt: int, headers: Mapping[str, str]) -> float:
+    """Seconds to wait before retrying, honouring Retry-After when sent"""
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        delay = _parse_reset(retry_after)
+        if delay is not None:
+            return delay
+    return BACKOFF_SECONDS * 2 ** attempt + random.random()
+
+def should_retry(status_code: int) -> bool:
+    """Check whether a response status is worth retrying"""
+    return status_code == 429 or status_code >= 500
+
+class RateLimitedAdapter(HTTPAdapter):
+    """HTTPAdapter that paces requests per host and retries throttled ones"""
+
+    def __init__(self, attempts: int = MAX_ATTEMPTS, **kwargs):
+        super().__init__(**kwargs)
+        self.rate, self.burst, self.max_wait = rate_settings()
+        self.attempts = attempts
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._buckets_lock = threading.Lock()
+
+    def bucket(self, host: str) -> TokenBucket:
+        """Get the token bucket for a host"""
+        with self._buckets_lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets[host]
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        bucket = self.bucket(urlparse(request.url).netloc)
+        deadline = time.monotonic() + self.max_wait
+        for attempt in range(self.attempts):
+            bucket.acquire(max(0.0, deadline - time.monotonic()))
+            response = super().send(request, **kwargs)
+            sync_bucket(bucket, response.headers)
+            if not should_retry(response.status_code) or attempt == self.attempts - 1:
+                return response
+            delay = retry_delay(attempt, response.headers)
+            if delay > deadline - time.monotonic():
+                # Waiting that long would hold the caller; hand back the error
+                return response
+            logger.warning(
+                "PSN returned %s for %s, retrying in %.1fs",
+                response.status_code, request.url, delay
+            )
+            response.close()
+            time.sleep(delay)
+        return response
@@ -1,19 +1,84 @@
 import fastapi
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, Response
+from fastapi.utils import is_body_allowed_for_status_code
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from routes import router
+from _psnawp import PSNClient, DEFAULT_DISK_CACHE_DIR
+from _ratelimit import RateLimited
 import os
+import math
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Log records are queued by request handlers and written by a background
+# thread, so logging never blocks the event loop on stdout
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_handler = QueueHandler(_log_queue)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_listener = QueueListener(_log_queue, output, respect_handler_level=True)
+    log_listener.start()
+    root = logging.getLogger()
+    root.addHandler(_log_handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+    # Log in to PSN once at startup so every request shares the same
+    # PSNAWP session and async HTTP client (see routes.get_psn)
+    app.state.psn = PSNClient(
+        os.getenv("NPSSO"),
+        cache_dir=os.getenv("PSN_CACHE_DIR", DEFAULT_DISK_CACHE_DIR)
+    )
+    try:
+        yield
+    finally:
+        await app.state.psn.aclose()
+        root.removeHandler(_log_handler)
+        log_listener.stop()
+
 # Create FastAPI app with metadata
 app = FastAPI(
     title="PSN API",
     description="API for PSN services",
-    version="0.1.0"
+    version="0.1.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
+# default_response_class only covers route responses; FastAPI's built-in
+# error handlers use JSONResponse, so route those through orjson as well
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    headers = getattr(exc, "headers", None)
+    if not is_body_allowed_for_status_code(exc.status_code):
+        return Response(status_code=exc.status_code, headers=headers)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=headers)
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    return ORJSONResponse({"detail": jsonable_encoder(exc.errors())}, status_code=422)
+
+# PSN calls give up rather than wait out a long rate-limit window, so tell
+# the client when to come back instead of holding its connection open
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    return ORJSONResponse(
+        {"detail": str(exc)},
+        status_code=429,
+        headers={"Retry-After": str(math.ceil(exc.retry_after))}
+    )
+
 # Include the router from routes.py
 app.include_router(router)
 
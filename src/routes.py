@@ -1,7 +1,18 @@
-from fastapi import APIRouter, HTTPException, Depends, Query, Path, Body
-from typing import List, Dict, Any, Optional, Set
-from _psnawp import get_psn_user, PSNUserProfile
-from pydantic import BaseModel, Field
+import asyncio
+import logging
+import operator
+import re
+import orjson
+from datetime import timedelta
+from functools import lru_cache
+from fastapi import APIRouter, HTTPException, Depends, Query, Path, Body, Request
+from fastapi.responses import StreamingResponse
+from typing import List, Dict, Any, Optional, Set, FrozenSet, Iterable, AsyncIterator, Callable, Tuple
+from _psnawp import get_psn_user, PSNUserProfile, PSNClient, BATCH_PROFILE_FIELDS, PSN_ERRORS
+from _ratelimit import RateLimited
+from pydantic import BaseModel, Field, field_validator
+
+logger = logging.getLogger(__name__)
 
 # Create router with API prefix and tags for better documentation
 router = APIRouter(
@@ -10,7 +21,7 @@ router = APIRouter(
 )
 
 # Available fields that can be requested
-AVAILABLE_USER_FIELDS = {
+AVAILABLE_USER_FIELDS = frozenset({
     # Basic info
     "online_id", "account_id", "about_me", "avatars", 
     "languages", "is_plus", "is_officially_verified",
@@ -24,28 +35,46 @@ AVAILABLE_USER_FIELDS = {
     
     # Trophy information
     "trophy_level", "trophy_progress", "trophy_tier", "earned_trophies",
-}
+})
 
 class UserRequest(BaseModel):
     """Model for requesting user data with specific fields"""
     online_id: str
-    fields: Optional[List[str]] = Field(
+    fields: Optional[FrozenSet[str]] = Field(
         default=None, 
         description="Specific fields to include in response. Omit for all fields."
     )
 
+    @field_validator("fields", mode="after")
+    @classmethod
+    def parse_fields(cls, v: Optional[FrozenSet[str]]) -> Optional[FrozenSet[str]]:
+        """Drop requested fields that aren't available, once pydantic has validated them"""
+        # An empty list means "all fields", same as omitting it
+        if not v:
+            return None
+        return AVAILABLE_USER_FIELDS.intersection(v)
+
 class BatchUserRequest(BaseModel):
     """Model for requesting data for multiple users"""
     users: List[UserRequest]
 
+# Upper bound on users fetched from PSN at the same time in a batch
+BATCH_CONCURRENCY = 64
+
+# Dependency to get the app's shared PSN client
+def get_psn(request: Request) -> PSNClient:
+    """Dependency that returns the PSN client created at startup"""
+    return request.app.state.psn
+
 # Dependency to get a PSN user profile
 async def get_psn_profile(
-    online_id: str = Path(..., description="PlayStation Network ID")
+    online_id: str = Path(..., description="PlayStation Network ID"),
+    psn: PSNClient = Depends(get_psn)
 ) -> PSNUserProfile:
     """Dependency that retrieves a PSN user profile"""
     try:
-        return get_psn_user(online_id)
-    except Exception as e:
+        return await get_psn_user(psn, online_id)
+    except PSN_ERRORS as e:
         raise HTTPException(status_code=404, detail=f"User not found: {str(e)}")
 
 # Get API status
@@ -64,6 +93,11 @@ async def get_user_profile(
         None, 
         description="Specific fields to include in response (comma-separated). Omit for all fields."
     ),
+    prune: bool = Query(
+        False,
+        description="Drop empty values (blank text, empty lists); counts and flags are always kept."
+    ),
+    psn: PSNClient = Depends(get_psn),
 ):
     """
     Get a user's PSN profile with field selection.
@@ -78,85 +112,103 @@ async def get_user_profile(
     - Trophies: trophy_level, trophy_progress, trophy_tier, earned_trophies
     """
     try:
-        user = get_psn_user(online_id)
+        user = await get_psn_user(psn, online_id)
         
         # Get all profile data
-        profile = user.get_full_profile()
-        
-        # Filter fields if specified
-        if fields:
-            valid_fields = [f for f in fields if f in AVAILABLE_USER_FIELDS]
-            return {k: profile[k] for k in valid_fields if k in profile}
+        profile = await user.get_full_profile()
         
-        return profile
-    except Exception as e:
+        profile = _filter_fields(profile, fields)
+        return _prune(profile) if prune else profile
+    except PSN_ERRORS as e:
         raise HTTPException(status_code=404, detail=f"User not found: {str(e)}")
 
-# Shortcut endpoints for common data
+# Fields returned by the shortcut endpoints for common data
+_BASIC_KEYS = ("online_id", "about_me", "avatars")
+_PRESENCE_KEYS = ("online_id", "online_status", "platform", "last_online", "availability")
+_FRIENDS_KEYS = ("online_id", "friends_count", "mutual_friends_count", "friend_relation")
+_TROPHY_KEYS = ("online_id", "trophy_level", "trophy_progress", "trophy_tier", "earned_trophies")
+
+# How each shortcut field is read from a PSNUserProfile
+_FIELD_GETTERS: Dict[str, Callable[[PSNUserProfile], Any]] = {
+    "online_id": operator.attrgetter("online_id"),
+    "about_me": PSNUserProfile.get_about_me,
+    "avatars": PSNUserProfile.get_avatars,
+    "online_status": PSNUserProfile.get_online_status,
+    "platform": PSNUserProfile.get_platform,
+    "last_online": PSNUserProfile.get_last_online_date,
+    "availability": PSNUserProfile.get_availability,
+    "friends_count": PSNUserProfile.get_friends_count,
+    "mutual_friends_count": PSNUserProfile.get_mutual_friends_count,
+    "friend_relation": PSNUserProfile.get_friend_relation,
+    "trophy_level": PSNUserProfile.get_trophy_level,
+    "trophy_progress": PSNUserProfile.get_trophy_progress,
+    "trophy_tier": PSNUserProfile.get_trophy_tier,
+    "earned_trophies": PSNUserProfile.get_earned_trophies,
+}
+
+def _projector(keys: Tuple[str, ...]) -> Callable[[PSNUserProfile], Dict[str, Any]]:
+    """Build a function that reads the given fields from a user, in order"""
+    getters = tuple(_FIELD_GETTERS[k] for k in keys)
+
+    def project(user: PSNUserProfile) -> Dict[str, Any]:
+        return dict(zip(keys, [get(user) for get in getters]))
+
+    return project
+
+_project_basic = _projector(_BASIC_KEYS)
+_project_presence = _projector(_PRESENCE_KEYS)
+_project_friends = _projector(_FRIENDS_KEYS)
+_project_trophies = _projector(_TROPHY_KEYS)
+
+# Shortcut endpoints for common data, each fetching only the source it reads
 @router.get("/users/{online_id}/basic")
-async def get_user_basic_info(online_id: str):
+async def get_user_basic_info(online_id: str, psn: PSNClient = Depends(get_psn)):
     """Get basic user information (online_id, about_me, avatars)"""
     try:
-        user = get_psn_user(online_id)
-        profile = user.get_full_profile()
-        return {
-            "online_id": profile["online_id"],
-            "about_me": profile["about_me"],
-            "avatars": profile["avatars"]
-        }
-    except Exception as e:
+        user = await get_psn_user(psn, online_id)
+        await user.prefetch("profile")
+        return _project_basic(user)
+    except PSN_ERRORS as e:
         raise HTTPException(status_code=404, detail=f"User not found: {str(e)}")
 
 @router.get("/users/{online_id}/presence")
-async def get_user_presence(online_id: str):
+async def get_user_presence(online_id: str, psn: PSNClient = Depends(get_psn)):
     """Get user's online presence information"""
     try:
-        user = get_psn_user(online_id)
-        profile = user.get_full_profile()
-        return {
-            "online_id": profile["online_id"],
-            "online_status": profile["online_status"],
-            "platform": profile["platform"],
-            "last_online": profile["last_online"],
-            "availability": profile["availability"]
-        }
-    except Exception as e:
+        user = await get_psn_user(psn, online_id)
+        await user.prefetch("presence")
+        return _project_presence(user)
+    except PSN_ERRORS as e:
         raise HTTPException(status_code=404, detail=f"User not found: {str(e)}")
 
 @router.get("/users/{online_id}/friends")
-async def get_user_friends_info(online_id: str):
+async def get_user_friends_info(online_id: str, psn: PSNClient = Depends(get_psn)):
     """Get information about a user's friends"""
     try:
-        user = get_psn_user(online_id)
-        profile = user.get_full_profile()
-        return {
-            "online_id": profile["online_id"],
-            "friends_count": profile["friends_count"],
-            "mutual_friends_count": profile["mutual_friends_count"],
-            "friend_relation": profile["friend_relation"]
-        }
-    except Exception as e:
+        user = await get_psn_user(psn, online_id)
+        await user.prefetch("friendship")
+        return _project_friends(user)
+    except PSN_ERRORS as e:
         raise HTTPException(status_code=404, detail=f"User not found: {str(e)}")
 
 @router.get("/users/{online_id}/trophies")
-async def get_user_trophies(online_id: str):
+async def get_user_trophies(online_id: str, psn: PSNClient = Depends(get_psn)):
     """Get user's trophy information"""
     try:
-        user = get_psn_user(online_id)
-        profile = user.get_full_profile()
-        return {
-            "online_id": profile["online_id"],
-            "trophy_level": profile["trophy_level"],
-            "trophy_progress": profile["trophy_progress"],
-            "trophy_tier": profile.get("trophy_tier", 0),
-            "earned_trophies": profile["earned_trophies"]
-        }
-    except Exception as e:
+        user = await get_psn_user(psn, online_id)
+        await user.prefetch("trophy_summary")
+        return _project_trophies(user)
+    except PSN_ERRORS as e:
         raise HTTPException(status_code=404, detail=f"User not found: {str(e)}")
 
 @router.post("/users/batch")
 async def batch_get_users(
-    request: BatchUserRequest = Body(..., description="Batch request for multiple users")
+    request: BatchUserRequest = Body(..., description="Batch request for multiple users"),
+    prune: bool = Query(
+        False,
+        description="Drop empty values (blank text, empty lists); counts and flags are always kept."
+    ),
+    psn: PSNClient = Depends(get_psn),
 ):
     """
     Get information for multiple users in a single request.
@@ -169,29 +221,92 @@ async def batch_get_users(
     - Friendship: friends_count, mutual_friends_count, friend_relation, is_blocking
     - Trophies: trophy_level, trophy_progress, trophy_tier, earned_trophies
     """
-    results = []
-    
-    for user_req in request.users:
+    results: List[Optional[Dict[str, Any]]] = [None] * len(request.users)
+
+    # Users who only want basic profile fields share the batch profiles endpoint
+    batchable = [i for i, user_req in enumerate(request.users) if _is_batchable(user_req)]
+    if batchable:
+        fields = frozenset().union(*(request.users[i].fields for i in batchable))
         try:
-            user = get_psn_user(user_req.online_id)
-            profile = user.get_full_profile()
-            
-            # Filter fields if specified
-            if user_req.fields:
-                valid_fields = [f for f in user_req.fields if f in AVAILABLE_USER_FIELDS]
-                results.append({k: profile[k] for k in valid_fields if k in profile})
-            else:
-                results.append(profile)
-                
+            profiles = await psn.batch_profiles(
+                [request.users[i].online_id for i in batchable],
+                sorted(fields)
+            )
         except Exception:
+            logger.exception("Error fetching batch profiles")
+            profiles = {}
+        for i in batchable:
+            profile = profiles.get(request.users[i].online_id.lower())
+            if profile is not None:
+                results[i] = _filter_fields(profile, request.users[i].fields)
+
+    # Everyone else, and anyone the batch endpoint missed, is fetched per user
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def fetch_one(user_req: UserRequest) -> Dict[str, Any]:
+        async with sem:
+            return await _build_profile(psn, user_req)
+
+    pending = [i for i, result in enumerate(results) if result is None]
+    fetched = await asyncio.gather(
+        *[fetch_one(request.users[i]) for i in pending],
+        return_exceptions=True
+    )
+    for i, result in zip(pending, fetched):
+        if isinstance(result, RateLimited):
+            result = {"online_id": request.users[i].online_id, "error": str(result)}
+        elif isinstance(result, Exception):
             # Add a placeholder for users that couldn't be found
-            results.append({
-                "online_id": user_req.online_id,
-                "error": "User not found"
-            })
-    
+            result = {"online_id": request.users[i].online_id, "error": "User not found"}
+        results[i] = result
+
+    if prune:
+        return [result if "error" in result else _prune(result) for result in results]
     return results
 
+def _is_batchable(user_req: UserRequest) -> bool:
+    """Check whether every requested field is served by the batch endpoint"""
+    # Fields are already narrowed to AVAILABLE_USER_FIELDS by UserRequest
+    return bool(user_req.fields) and user_req.fields.issubset(BATCH_PROFILE_FIELDS)
+
+@lru_cache(maxsize=64)
+def _make_projector(fields: FrozenSet[str]) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    """Compile a straight-line dict builder for one set of requested fields
+
+    Clients tend to repeat the same field sets, so each distinct set is
+    compiled once and the builder reused for every matching profile.
+    """
+    # Only names from AVAILABLE_USER_FIELDS get here, and repr() quotes them,
+    # so the generated source can't contain anything but dict lookups
+    if not fields <= AVAILABLE_USER_FIELDS:
+        raise ValueError(f"Unknown fields: {sorted(fields - AVAILABLE_USER_FIELDS)}")
+    src = "lambda p: {" + ", ".join(f"{k!r}: p.get({k!r})" for k in sorted(fields)) + "}"
+    return eval(src)
+
+def _filter_fields(profile: Dict[str, Any], fields: Optional[Iterable[str]]) -> Dict[str, Any]:
+    """Keep only the requested fields of a profile, if any were requested"""
+    if fields is not None:
+        return _make_projector(AVAILABLE_USER_FIELDS.intersection(fields))(profile)
+
+    return profile
+
+# Profile values that can be falsy but still mean something, kept when pruning
+_KEEP_FALSY_FIELDS = frozenset({
+    "is_plus", "is_officially_verified", "is_blocking",
+    "friends_count", "mutual_friends_count",
+    "trophy_level", "trophy_progress", "trophy_tier",
+})
+
+def _prune(profile: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop empty values from a profile, keeping zero counts and False flags"""
+    return {k: v for k, v in profile.items() if v or k in _KEEP_FALSY_FIELDS}
+
+async def _build_profile(psn: PSNClient, user_req: UserRequest) -> Dict[str, Any]:
+    """Fetch a single user's profile for a batch request"""
+    user = await get_psn_user(psn, user_req.online_id)
+    profile = await user.get_full_profile()
+    return _filter_fields(profile, user_req.fields)
+
 # Search endpoint
 @router.get("/users")
 async def search_users(
@@ -200,6 +315,11 @@ async def search_users(
         None, 
         description="Specific fields to include in response (comma-separated). Omit for all fields."
     ),
+    prune: bool = Query(
+        False,
+        description="Drop empty values (blank text, empty lists); counts and flags are always kept."
+    ),
+    psn: PSNClient = Depends(get_psn),
 ):
     """
     Search for PSN users with field selection
@@ -211,73 +331,164 @@ async def search_users(
     - Trophies: trophy_level, trophy_progress, trophy_tier, earned_trophies
     """
     try:
-        user = get_psn_user(query)
-        profile = user.get_full_profile()
-        
-        # Filter fields if specified
-        if fields:
-            valid_fields = [f for f in fields if f in AVAILABLE_USER_FIELDS]
-            return [{k: profile[k] for k in valid_fields if k in profile}]
+        user = await get_psn_user(psn, query)
+        profile = await user.get_full_profile()
         
-        return [profile]
-    except Exception:
+        profile = _filter_fields(profile, fields)
+        return [_prune(profile) if prune else profile]
+    except PSN_ERRORS:
         return []
 
 @router.get("/users/{online_id}/raw-profile")
-async def get_user_raw_profile(online_id: str):
+async def get_user_raw_profile(online_id: str, psn: PSNClient = Depends(get_psn)):
     """
     Get the raw profile data directly from the PSN API.
     
     This returns the unprocessed profile data as provided by the PSNAWP library.
     """
     try:
-        user = get_psn_user(online_id)
-        return user.profile
-    except Exception as e:
+        user = await get_psn_user(psn, online_id)
+        return await user.fetch_profile()
+    except PSN_ERRORS as e:
         raise HTTPException(status_code=404, detail=f"User not found: {str(e)}")
 
+# ISO 8601 durations as PSN reports play time, e.g. "PT12H3M4S"
+_DURATION_RE = re.compile(
+    r"P(?:(?P<days>\d+)D)?"
+    r"(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>[\d.]+)S)?)?"
+)
+
+def _format_duration(value: str) -> str:
+    """Render a PSN play duration as H:MM:SS, like str(timedelta)"""
+    match = _DURATION_RE.fullmatch(value or "")
+    if not match:
+        return value
+    parts = {k: float(v) for k, v in match.groupdict().items() if v}
+    return str(timedelta(**parts))
+
+def _trophy_title_row(title: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a PSN trophy title into a response row"""
+    return {
+        "title_id": title["npCommunicationId"],
+        "title_name": title["trophyTitleName"],
+        "platform": title["trophyTitlePlatform"],
+        "trophies_earned": sum(title["earnedTrophies"].values()),
+        "trophies_total": sum(title["definedTrophies"].values()),
+        "progress": title["progress"]
+    }
+
+def _game_row(title: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a PSN title stats entry into a response row"""
+    return {
+        "name": title["name"],
+        "title_id": title["titleId"],
+        "platform": title["category"],
+        "image_url": title.get("imageUrl"),
+        "play_count": title.get("playCount", 0),
+        "first_played": title.get("firstPlayedDateTime"),
+        "last_played": title.get("lastPlayedDateTime"),
+        "play_duration": _format_duration(title.get("playDuration", ""))
+    }
+
+async def _rows(
+    items: AsyncIterator[Dict[str, Any]],
+    to_row: Callable[[Dict[str, Any]], Dict[str, Any]],
+    kind: str
+) -> AsyncIterator[Dict[str, Any]]:
+    """Convert items to response rows, skipping any that can't be processed"""
+    async for item in items:
+        try:
+            yield to_row(item)
+        except Exception:
+            logger.exception("Error processing %s", kind)
+
+async def _ndjson(rows: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Serialize rows as newline-delimited JSON
+
+    The 200 has already been sent by the time later pages are fetched, so
+    an error there ends the stream with an {"error": ...} line instead.
+    """
+    try:
+        async for row in rows:
+            yield orjson.dumps(row) + b"\n"
+    except Exception as e:
+        logger.exception("Error streaming rows")
+        yield orjson.dumps({"error": str(e)}) + b"\n"
+
+async def _started(rows: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    """Fetch the first row before the response starts
+
+    Errors on the first page, a 429 included, then still become a normal
+    error response. Returns an iterator over all the rows.
+    """
+    try:
+        first = await anext(rows)
+    except StopAsyncIteration:
+        first = None
+
+    async def resumed() -> AsyncIterator[Dict[str, Any]]:
+        if first is None:
+            return
+        yield first
+        async for row in rows:
+            yield row
+
+    return resumed()
+
 @router.get("/users/{online_id}/trophy-titles")
 async def get_trophy_titles(
     online_id: str,
-    limit: Optional[int] = Query(None, description="Max number of titles to retrieve")
+    limit: Optional[int] = Query(None, description="Max number of titles to retrieve"),
+    psn: PSNClient = Depends(get_psn)
 ):
     """
     Get the user's trophy titles (games they have trophies for)
     
     This endpoint returns the list of games for which the user has earned trophies.
     It supports limiting the number of titles returned.
+
+    For users with many titles prefer /trophy-titles/stream, which starts
+    responding before every page has been fetched.
     """
     try:
-        user = get_psn_user(online_id)
+        user = await get_psn_user(psn, online_id)
         trophy_titles = user.get_trophy_titles(limit=limit)
         
         # Return titles in a list format
-        title_list = []
-        for title in trophy_titles:
-            try:
-                title_list.append({
-                    "title_id": title.title_id,
-                    "title_name": title.title_name,
-                    "platform": str(title.platform),
-                    "trophies_earned": title.earned_trophies.total,
-                    "trophies_total": title.defined_trophies.total,
-                    "progress": title.progress
-                })
-            except Exception as e:
-                print(f"Error processing title: {e}")
+        title_list = [row async for row in _rows(trophy_titles, _trophy_title_row, "title")]
         
         return {
             "online_id": online_id,
             "total_titles": len(title_list),
             "titles": title_list
         }
-    except Exception as e:
+    except PSN_ERRORS as e:
         raise HTTPException(status_code=404, detail=f"Could not retrieve trophy titles: {str(e)}")
 
+@router.get("/users/{online_id}/trophy-titles/stream")
+async def stream_trophy_titles(
+    online_id: str,
+    limit: Optional[int] = Query(None, description="Max number of titles to retrieve"),
+    psn: PSNClient = Depends(get_psn)
+):
+    """
+    Stream the user's trophy titles as newline-delimited JSON
+
+    Each line is one title, in the same shape as the entries of /trophy-titles.
+    """
+    try:
+        user = await get_psn_user(psn, online_id)
+        trophy_titles = user.get_trophy_titles(limit=limit)
+        rows = await _started(_rows(trophy_titles, _trophy_title_row, "title"))
+    except PSN_ERRORS as e:
+        raise HTTPException(status_code=404, detail=f"Could not retrieve trophy titles: {str(e)}")
+    return StreamingResponse(_ndjson(rows), media_type="application/x-ndjson")
+
 @router.get("/users/{online_id}/games")
 async def get_played_games(
     online_id: str,
-    limit: Optional[int] = Query(None, description="Max number of games to retrieve")
+    limit: Optional[int] = Query(None, description="Max number of games to retrieve"),
+    psn: PSNClient = Depends(get_psn)
 ):
     """
     Get a list of games the user has played with detailed statistics
@@ -290,32 +501,40 @@ async def get_played_games(
     - First played date
     - Last played date
     - Play duration
+
+    For users with many games prefer /games/stream, which starts
+    responding before every page has been fetched.
     """
     try:
-        user = get_psn_user(online_id)
+        user = await get_psn_user(psn, online_id)
         title_iterator = user.get_title_stats(limit=limit)
         
         # Return game data in a list format
-        game_list = []
-        for title in title_iterator:
-            try:
-                game_list.append({
-                    "name": title.name,
-                    "title_id": title.title_id,
-                    "platform": title.category,
-                    "image_url": title.image_url,
-                    "play_count": title.play_count,
-                    "first_played": title.first_played_date_time,
-                    "last_played": title.last_played_date_time,
-                    "play_duration": str(title.play_duration)
-                })
-            except Exception as e:
-                print(f"Error processing game: {e}")
+        game_list = [row async for row in _rows(title_iterator, _game_row, "game")]
         
         return {
             "online_id": online_id,
             "total_games": len(game_list),
             "games": game_list
         }
-    except Exception as e:
-        raise HTTPException(status_code=404, detail=f"Could not retrieve game stats: {str(e)}")
\ No newline at end of file
+    except PSN_ERRORS as e:
+        raise HTTPException(status_code=404, detail=f"Could not retrieve game stats: {str(e)}")
+
+@router.get("/users/{online_id}/games/stream")
+async def stream_played_games(
+    online_id: str,
+    limit: Optional[int] = Query(None, description="Max number of games to retrieve"),
+    psn: PSNClient = Depends(get_psn)
+):
+    """
+    Stream the games the user has played as newline-delimited JSON
+
+    Each line is one game, in the same shape as the entries of /games.
+    """
+    try:
+        user = await get_psn_user(psn, online_id)
+        title_iterator = user.get_title_stats(limit=limit)
+        rows = await _started(_rows(title_iterator, _game_row, "game"))
+    except PSN_ERRORS as e:
+        raise HTTPException(status_code=404, detail=f"Could not retrieve game stats: {str(e)}")
+    return StreamingResponse(_ndjson(rows), media_type="application/x-ndjson")
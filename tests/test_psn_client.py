@@ -0,0 +1,36 @@
+import asyncio
+import os
+import pytest
+from psnawp_api import PSNAWP
+from src._psnawp import PSNClient, _fresh_access_token, _requester
+
+def test_fresh_access_token_logs_in_then_refreshes(monkeypatch):
+    """The installed PSNAWP logs in on first use and refreshes after that"""
+    client = PSNAWP("fake-npsso")
+    authenticator = _requester(client)
+    calls = []
+
+    def log_in(code):
+        calls.append(("authorization", code))
+        authenticator.token_response = {"access_token": "first"}
+
+    def refresh():
+        calls.append(("refresh",))
+        authenticator.token_response = {"access_token": "second"}
+
+    monkeypatch.setattr(authenticator, "get_authorization_code", lambda: "code")
+    monkeypatch.setattr(authenticator, "fetch_access_token_from_authorization", log_in)
+    monkeypatch.setattr(authenticator, "fetch_access_token_from_refresh", refresh)
+
+    assert _fresh_access_token(client) == "first"
+    assert _fresh_access_token(client) == "second"
+    assert calls == [("authorization", "code"), ("refresh",)]
+
+@pytest.mark.skipif(not os.getenv("NPSSO"), reason="needs a real NPSSO token")
+def test_psn_client_gets_access_token():
+    """PSNClient logs in against PSN with the installed PSNAWP"""
+    psn = PSNClient(os.environ["NPSSO"])
+    try:
+        assert _fresh_access_token(psn.client)
+    finally:
+        asyncio.run(psn.aclose())